@@ -1,41 +1,197 @@
 import asyncio
 import contextlib
-import base64
+import fnmatch
+import functools
 import json
 import os
 import glob
+import re
 import shlex
 import shutil
-import uuid
 import time
 import yaml
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
 from . import conf
 from . import cmd_manager
 from . import util
 
 
+# parsed configs keyed by absolute path: (mtime_ns, config)
+_CONFIG_CACHE = {}
+
+# types of the dict return items, items of other types are ignored
+RETURN_TYPES = ('file', 'stdout', 'stderr', 'file_list')
+
+# number of trailing stderr bytes written to the log
+STDERR_LOG_SIZE = 4096
+
+# references to pending background tasks, so they are not garbage collected
+_BACKGROUND_TASKS = set()
+
+
 def load_config(filename, type=None):
     if type is None:
         type = filename.split('.')[-1]
-    with open(filename) as fd:
+    path = os.path.abspath(filename)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _CONFIG_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path) as fd:
         if type == 'json':
-            return json.load(fd)
+            config = json.load(fd)
         elif type == 'yaml' or type == 'yml':
-            return yaml.safe_load(fd)
+            config = yaml.load(fd, Loader=conf.YamlLoader)
+        else:
+            return None
+    _CONFIG_CACHE[path] = (mtime, config)
+    return config
 
 
 def load_all_configs(directory):
     configs = {}
-    for filename in os.listdir(directory):
-        if filename.endswith('.json') or filename.endswith('.yaml') or filename.endswith('.yml'):
-            config = load_config(f'{directory.rstrip("/")}/{filename}')
-            configs[config["name"]] = config
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith(('.json', '.yaml', '.yml')):
+                config = load_config(entry.path)
+                prepare_config(config)
+                configs[config["name"]] = config
     return configs
 
 
+@functools.lru_cache(maxsize=1024)
+def _compile_template(item):
+    tmpl = util.Template(item)
+    # items with only escaped or invalid placeholders are kept verbatim
+    return tmpl if tmpl.get_identifiers() else None
+
+
+def compile_input_item(item):
+    '''
+    Compile a command item into (text, template), the template is None if the
+    item has nothing to substitute.
+    '''
+    if item is None:
+        return '', None
+    if isinstance(item, (int, float, bool)):
+        # numeric and boolean scalars can not hold any substitution
+        return str(item), None
+    item = str(item)
+    if '$' not in item:
+        return item, None
+    return item, _compile_template(item)
+
+
+def prepare_config(config):
+    '''
+    Precompute the per-command data used on every run of the command.
+    '''
+    cwd = config.get("cwd", "") or conf.CONFIG.get('default_workdir')
+    config['_cwd'] = cwd.rstrip('/')
+    config['_command_templates'] = [compile_input_item(item) for item in config.get('command', [])]
+    config['_return_items'] = [compile_return_item(item) for item in config.get('return', [])
+                               if item in ('stdout', 'stderr')
+                               or (isinstance(item, dict) and item.get('type') in RETURN_TYPES)]
+
+
+def compile_return_item(item):
+    '''
+    Normalize a return item into (kind, name, path, mimetype, encoding, glob_re),
+    plain 'stdout' and 'stderr' items are of the private kind '_text'.
+    '''
+    if not isinstance(item, dict):
+        return '_text', item, None, '', 'base64', None
+    kind = item['type']
+    path = None
+    glob_re = None
+    if kind == 'file':
+        path = item['filename']
+    elif kind == 'file_list':
+        path = item.get('glob')
+        glob_re = compile_glob(path)
+    return kind, item['name'], path, item.get('mimetype', ''), item.get('encoding', 'base64'), glob_re
+
+
+def compile_glob(pattern):
+    '''
+    Compile a glob matching directly in the job directory into a regex, None if
+    the pattern is empty or walks into sub-directories.
+    '''
+    if not pattern or '/' in pattern:
+        return None
+    regex = fnmatch.translate(pattern)
+    if not pattern.startswith('.'):
+        # like glob, wildcards do not match hidden files
+        regex = r'(?!\.)' + regex
+    return re.compile(regex)
+
+
+def scan_files(directory, pattern_re):
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if pattern_re.match(entry.name) and entry.is_file():
+                yield entry.name
+
+
+def write_file(path, data):
+    '''
+    Write bytes to a file with raw os-level calls, no buffered file object.
+    '''
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
 def to_base64(data):
-    data = data.read() if hasattr(data, 'read') else data
-    return base64.b64encode(data).decode('utf-8')
+    return base64.b64encode(data).decode('ascii')
+
+
+def encode_file_b64(path, chunk=3 * 256 * 1024):
+    '''
+    Base64 encode a file chunk by chunk, the chunk size must be a multiple of 3
+    so that no padding is emitted in the middle of the output.
+    '''
+    encoded = bytearray()
+    with open(path, 'rb') as fd:
+        while data := fd.read(chunk):
+            encoded += base64.b64encode(data)
+    return encoded.decode('ascii')
+
+
+async def read_stream_b64(stream, chunk=3 * 256 * 1024):
+    '''
+    Base64 encode a stream while reading it, bytes not filling a whole 3 byte
+    group are carried over to the next chunk.
+    '''
+    encoded = bytearray()
+    pending = bytearray()
+    while data := await stream.read(chunk):
+        pending += data
+        cut = len(pending) - len(pending) % 3
+        # encode through a view, it must be released before resizing pending
+        with memoryview(pending)[:cut] as view:
+            encoded += base64.b64encode(view)
+        del pending[:cut]
+    encoded += base64.b64encode(pending)
+    return encoded.decode('ascii')
+
+
+async def read_stream_tail(stream, size, chunk=64 * 1024):
+    '''
+    Read a stream to the end, keeping only its last `size` bytes.
+    '''
+    tail = bytearray()
+    while data := await stream.read(chunk):
+        tail += data
+        del tail[:-size]
+    return bytes(tail)
 
 
 class CmdSession:
@@ -43,26 +199,33 @@ class CmdSession:
     A cmd executing session.
     '''
     def __init__(self, cmd_config):
+        if '_cwd' not in cmd_config:
+            prepare_config(cmd_config)
         self.cmd_config = cmd_config
         self.job_id = None
+        self._job_path = None
+        self._job_path_abs = None
         self._params_cache = {}
 
     @contextlib.asynccontextmanager
     async def job_context(self):
-        self.job_id = str(uuid.uuid4())
+        self.job_id = os.urandom(12).hex()
+        self._job_path = f'{self.cmd_config["_cwd"]}/{self.job_id}'
+        self._job_path_abs = os.path.abspath(self._job_path)
         try:
             self.ensure_job_path()
             yield
         finally:
             self.clean_job_path()
             self.job_id = None
+            self._job_path = None
+            self._job_path_abs = None
 
     def get_job_path(self):
-        cwd = self.cmd_config.get("cwd", "") or conf.CONFIG.get('default_workdir')
-        return f'{cwd.rstrip("/")}/{self.job_id}'
+        return self._job_path
     
     def get_job_file_path(self, filename):
-        return f'{self.get_job_path()}/{filename}'
+        return f'{self._job_path}/{filename}'
     
     def ensure_job_path(self):
         job_path = self.get_job_path()
@@ -70,7 +233,10 @@ class CmdSession:
 
     def clean_job_path(self):
         job_path = self.get_job_path()
-        shutil.rmtree(job_path, ignore_errors=True)
+        # delete in a worker thread, the response does not wait for it
+        task = asyncio.create_task(asyncio.to_thread(shutil.rmtree, job_path, ignore_errors=True))
+        _BACKGROUND_TASKS.add(task)
+        task.add_done_callback(_BACKGROUND_TASKS.discard)
 
     def get_params(self, *param_name_list, **kwargs):
         ret = {}
@@ -93,11 +259,10 @@ class CmdSession:
                     raise ValueError(f"Missing required param: {param_name}")
                 if param_config.get('type') == 'file':
                     filename = param_config.get('filename') or param_name
-                    with open(self.get_job_file_path(filename), 'wb') as fd:
-                        value = value or b''
-                        if isinstance(value, str):
-                            value = value.encode('utf-8')
-                        fd.write(value)
+                    value = value or b''
+                    if isinstance(value, str):
+                        value = value.encode('utf-8')
+                    write_file(self.get_job_file_path(filename), value)
                     ret[param_name] = filename
                 else:
                     ret[param_name] = value
@@ -105,94 +270,130 @@ class CmdSession:
         return ret
     
     async def preprocess_params(self, **kwargs):
-        for param_name in self.cmd_config.get('params', {}):
-            __ = self.get_params(param_name, **kwargs)
+        '''
+        Resolve all the params once, undeclared params are taken from kwargs as is.
+        '''
+        params = dict(kwargs)
+        params.update(self.get_params(*(self.cmd_config.get('params') or {}), **kwargs))
+        return params
 
-    def process_input_item(self, item, cmd_env, **kwargs):
-        if item is None:
-            return ''
-        else:
-            item = str(item)
-        tmpl  = util.Template(item)
-        param_name_list = tmpl.get_identifiers()
-        if param_name_list:
-            param_values = self.get_params(*param_name_list, **kwargs)
-            return tmpl.safe_substitute(cmd_env, **param_values)
-        else:
-            return item
+    def process_input_item(self, item, cmd_env):
+        text, tmpl = item
+        if tmpl is None:
+            return text
+        return tmpl.safe_substitute(cmd_env)
 
-    async def prepare_cmd(self, *args, **kwargs):
+    async def prepare_cmd(self, params):
         args_list = []
         cmd_env = {}
-        cmd_env['cwd'] = self.get_job_path()
-        cmd_env['cwd_abs'] = os.path.abspath(self.get_job_path())
-        for item in self.cmd_config['command']:
-            args_list.append(self.process_input_item(item, cmd_env, **kwargs))
+        cmd_env['cwd'] = self._job_path
+        cmd_env['cwd_abs'] = self._job_path_abs
+        cmd_env.update(params)
+        for item in self.cmd_config['_command_templates']:
+            args_list.append(self.process_input_item(item, cmd_env))
         result_args_list = []
         for i in args_list:
             result_args_list.extend(shlex.split(i))
-        return shlex.join(result_args_list)
+        return result_args_list
 
     async def execute(self, cmd, **kwargs):
         ret = {}
         proc_kwargs = {}
-        proc_kwargs['cwd'] = self.get_job_path()
+        job_path = self._job_path
+        proc_kwargs['cwd'] = job_path
+        return_items = self.cmd_config['_return_items']
+        stdout_text = any(kind == '_text' and name == 'stdout' for kind, name, *__ in return_items)
+        stderr_full = any(kind == 'stderr' or (kind == '_text' and name == 'stderr')
+                          for kind, name, *__ in return_items)
+        stdout_b64 = None
+        if stdout_text or any(kind == 'stdout' for kind, *__ in return_items):
+            proc_kwargs['stdout'] = asyncio.subprocess.PIPE
+        else:
+            # nobody consumes stdout, do not buffer it at all
+            proc_kwargs['stdout'] = asyncio.subprocess.DEVNULL
         begin_time = time.time()
-        process = await asyncio.create_subprocess_shell(cmd,
-                                                        stdout=asyncio.subprocess.PIPE,
-                                                        stderr=asyncio.subprocess.PIPE,
-                                                        **proc_kwargs
-                                                        )
-        (stdout, stderr) = await process.communicate()
+        process = None
+        stdout, stderr = b'', b''
+        if not cmd:
+            # like `sh -c ''`, an empty command succeeds doing nothing
+            returncode = 0
+        else:
+            try:
+                process = await asyncio.create_subprocess_exec(*cmd,
+                                                               stderr=asyncio.subprocess.PIPE,
+                                                               **proc_kwargs
+                                                               )
+            except OSError as e:
+                # report it the way the shell does: 126 not executable, 127 not found
+                returncode = 126 if isinstance(e, PermissionError) else 127
+                stderr = f'{cmd[0]}: {e.strerror or e}\n'.encode('utf-8')
+        if process is not None:
+            if stderr_full:
+                stderr_reader = process.stderr.read()
+            else:
+                # stderr is only logged, do not keep more than what is logged
+                stderr_reader = read_stream_tail(process.stderr, STDERR_LOG_SIZE)
+            if process.stdout is None:
+                stderr = await stderr_reader
+            elif stdout_text:
+                stdout, stderr = await asyncio.gather(process.stdout.read(), stderr_reader)
+            else:
+                # stdout is only returned base64 encoded, encode it while reading
+                stdout_b64, stderr = await asyncio.gather(read_stream_b64(process.stdout), stderr_reader)
+            returncode = await process.wait()
         end_time = time.time()
         util.json_log_info({
             'job_id': self.job_id,
-            'returncode': process.returncode,
+            'returncode': returncode,
             'used_time': end_time - begin_time,
-            'stderr': stderr.decode('utf-8'),
+            'stderr': stderr[-STDERR_LOG_SIZE:].decode('utf-8', errors='replace'),
         })
-        for item in self.cmd_config.get('return', []):
-            if item == 'stdout':
-                ret['stdout'] = stdout.decode('utf-8')
-            elif item == 'stderr':
-                ret['stderr'] = stderr.decode('utf-8')
-            elif isinstance(item, dict):
-                arg_name = item['name']
-                arg_type = item['type']
-                if arg_type == 'file':
-                    with open(self.get_job_file_path(item['filename']), 'rb') as fd:
-                        ret[arg_name] = {
-                            'body': to_base64(fd),
-                            'mimetype': item.get('mimetype', ''),
-                            'encoding': item.get('encoding', 'base64')
-                        }
-                if arg_type in ['stdout', 'stderr']:
-                    ret[arg_name] = {
-                        'body': to_base64(stdout if arg_type == 'stdout' else stderr),
-                        'mimetype': item.get('mimetype', ''),
-                        'encoding': item.get('encoding', 'base64')
-                    }
-                elif arg_type == 'file_list':
-                    ret[arg_name] = []
-                    root_dir = self.get_job_path()
-                    matched_filenames = []
-                    if item.get('glob'):
-                        matched_filenames = glob.glob(item['glob'], root_dir=root_dir)
-                    for filename in matched_filenames:
-                        with open(self.get_job_file_path(filename), 'rb') as fd:
-                            ret[arg_name].append({
-                                'body': to_base64(fd),
-                                'fielname': filename,
-                                'mimetype': item.get('mimetype', ''),
-                                'encoding': item.get('encoding', 'base64')
-                            })
+        for kind, arg_name, path, mimetype, encoding, glob_re in return_items:
+            if kind == '_text':
+                ret[arg_name] = (stdout if arg_name == 'stdout' else stderr).decode('utf-8')
+            elif kind == 'file':
+                ret[arg_name] = {
+                    'body': encode_file_b64(f'{job_path}/{path}'),
+                    'mimetype': mimetype,
+                    'encoding': encoding
+                }
+            elif kind == 'stdout':
+                if stdout_b64 is None:
+                    stdout_b64 = to_base64(stdout)
+                ret[arg_name] = {
+                    'body': stdout_b64,
+                    'mimetype': mimetype,
+                    'encoding': encoding
+                }
+            elif kind == 'stderr':
+                ret[arg_name] = {
+                    'body': to_base64(stderr),
+                    'mimetype': mimetype,
+                    'encoding': encoding
+                }
+            elif kind == 'file_list':
+                ret[arg_name] = []
+                matched_filenames = []
+                if glob_re is not None:
+                    matched_filenames = scan_files(job_path, glob_re)
+                elif path:
+                    # only regular files, same as scan_files
+                    matched_filenames = (filename for filename in glob.iglob(path, root_dir=job_path)
+                                         if os.path.isfile(f'{job_path}/{filename}'))
+                for filename in matched_filenames:
+                    ret[arg_name].append({
+                        'body': encode_file_b64(f'{job_path}/{filename}'),
+                        'fielname': filename,
+                        'mimetype': mimetype,
+                        'encoding': encoding
+                    })
         ret['job_id'] = self.job_id
         return ret
 
     async def run(self, **kwargs):
         async with self.job_context():
-            await self.preprocess_params(**kwargs)
-            cmd = await self.prepare_cmd(**kwargs)
+            params = await self.preprocess_params(**kwargs)
+            cmd = await self.prepare_cmd(params)
             util.json_log_info({
                 'job_id': self.job_id,
                 'cmd': cmd})
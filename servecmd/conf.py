@@ -2,6 +2,12 @@ import json
 import os
 import logging
 import yaml
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+    logging.getLogger('servecmd').warning(
+        'PyYAML is built without libyaml, falling back to the slower pure Python loader')
 
 CONFIG = {
     'default_workdir': f'{os.getcwd()}/servecmd_default',
@@ -25,7 +31,7 @@ def load(config_file=None):
                 if location.endswith('.json'):
                     CONFIG.update(json.load(f))
                 elif location.endswith('.yaml') or location.endswith('.yml'):
-                    CONFIG.update(yaml.safe_load(f))
+                    CONFIG.update(yaml.load(f, Loader=YamlLoader))
                 else:
                     raise ValueError('Unsupported config file type')
         except FileNotFoundError:
@@ -3,23 +3,39 @@ import logging
 import datetime
 from string import Template
 from fastapi import UploadFile
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger('servecmd')
 
+json_loads = orjson.loads if orjson is not None else json.loads
+
+
 def json_log_info(data):
-    data['created'] = datetime.datetime.now().isoformat()
-    logger.info(json.dumps(data))
+    if orjson is not None:
+        # orjson serializes datetime as ISO 8601 natively
+        logger.info(orjson.dumps({**data, 'created': datetime.datetime.now()}).decode())
+    else:
+        data['created'] = datetime.datetime.now().isoformat()
+        logger.info(json.dumps(data))
 
 
 # back patch for string.Template.get_identifiers()
 if not hasattr(Template, 'get_identifiers'):
     def get_identifiers(self):
+        if self.delimiter not in self.template:
+            return []
         ids = []
+        seen = set()
+        append = ids.append
         for mo in self.pattern.finditer(self.template):
             named = mo.group('named') or mo.group('braced')
-            if named is not None and named not in ids:
+            if named is not None and named not in seen:
                 # add a named group only the first time it appears
-                ids.append(named)
+                seen.add(named)
+                append(named)
             elif (named is None
                 and mo.group('invalid') is None
                 and mo.group('escaped') is None):
@@ -36,16 +52,16 @@ async def process_request(req):
     json_data = {}
     content_type = (req.headers.get('content-type') or '').lower()
     if content_type == 'application/json':
-        json_data = await req.json()
+        json_data = json_loads(await req.body())
     elif content_type.startswith('multipart/form-data'):
         async with req.form() as form:
             for key, value in form.items():
                 if value.content_type == 'application/json':
-                    json_data = json.loads(value.file.read())
+                    json_data = json_loads(await value.read())
                 else:
                     files.append({
                         'filename': value.filename,
                         'size': value.size,
-                        'file': value.file.read()
+                        'file': await value.read()
                     })
     return {'json': json_data, 'files': files}